@@ -29,6 +29,11 @@ class ConfigBase:
     pretest:bool=True
     seed_everything:int|None=1234
     compile:bool=False
+    # forwarded to torch.compile, e.g. mode='reduce-overhead' replays CUDA graphs, which needs fixed input shapes (dynamic=False)
+    compile_mode:str|None=None
+    compile_fullgraph:bool=False
+    compile_dynamic:bool|None=None
+    compile_max_autotune_gemm:bool=False
 
     model_factory:Callable[..., torch.nn.Module]=field_default(lambda: Factory(torch.nn.Module))
 
@@ -107,6 +112,9 @@ def cli():
         torch.set_float32_matmul_precision("high")
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.allow_tf32 = True
+        # let scaled_dot_product_attention (model.core.TorchAttention) pick the fused flash / memory efficient kernels
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
 
     # NOTE - we have to replace identifier accessors here, because if dataloader forks new processes, then
     #  those won't be able to access the values from the loaded cfgctx module unless they're materialized in advance here
@@ -25,6 +25,10 @@ LOG_NAME = 'LLaMa2 L12D768H12CM2Adam'
 cli.Config(
     seed_everything = 1337,
     compile = True,
+    compile_mode = 'reduce-overhead',
+    compile_fullgraph = True,
+    compile_dynamic = False, # set to True if validation ever runs with variable sequence lengths
+    compile_max_autotune_gemm = True,
 
     model_factory = lambda: model.core.Decoder(
         hparams = model.hparams.HParams(
@@ -52,6 +56,8 @@ cli.Config(
             params=params,
             lr=6e-4,
             betas=(0.9,0.999),
+            eps=1e-8,
+            fused=True,
         ),
         lightning_trainer_factory = lambda: lightning.Trainer(
             enable_progress_bar=False,
@@ -72,7 +78,11 @@ cli.Config(
             tokenizer_factory=TOKENIZER_FACTORY, 
             batch_size=BATCH_SIZE, 
             sequence_length=MAX_SEQUENCE_LENGTH, 
-            num_workers=4,
+            num_workers=None, # one worker per host core, up to 16
+            pin_memory=True,
+            persistent_workers=True,
+            prefetch_factor=4,
+            drop_last=True, # fixed training batch shapes for the reduce-overhead CUDA graphs
             seed=32,
         ),
     ),
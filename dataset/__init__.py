@@ -133,16 +133,24 @@ class DM(lightning.LightningDataModule):
     tokenizer_factory:typing.Callable
     sequence_length:int
     batch_size:int=1
-    num_workers:int=0
+    num_workers:int|None=0 # None picks one worker per host core, up to 16
     seed:int|None=None
-
-    def get_dataloader(self, ds: Dataset, shuffle: bool|None = None):
+    pin_memory:bool=True
+    persistent_workers:bool=True
+    prefetch_factor:int|None=None
+    drop_last:bool=False # set when every training batch must have the same shape, e.g. so compiled CUDA graphs can be replayed
+
+    def get_dataloader(self, ds: Dataset, shuffle: bool|None = None, drop_last: bool = False):
+        num_workers = self.num_workers if self.num_workers is not None else min(os.cpu_count() or 1, 16)
+        num_workers = min(ds.n_shards, num_workers)
+        # worker-only options are rejected by DataLoader when loading in the main process
         return DataLoader(ds, 
-                          #prefetch_factor=4, 
-                          persistent_workers=True,
+                          prefetch_factor=self.prefetch_factor if num_workers > 0 else None, 
+                          persistent_workers=self.persistent_workers and num_workers > 0,
                           batch_size=self.batch_size, 
+                          drop_last=drop_last,
                           shuffle=shuffle, 
-                          num_workers=min(ds.n_shards, self.num_workers), pin_memory=True, collate_fn=collate_target_tokens_offset_by_one_input_ids)
+                          num_workers=num_workers, pin_memory=self.pin_memory, collate_fn=collate_target_tokens_offset_by_one_input_ids)
 
     def get_dataset(self, split):
         tokenizer = self.tokenizer_factory()
@@ -152,7 +160,8 @@ class DM(lightning.LightningDataModule):
         ds = ds.shuffle(seed=self.seed)
         if split == 'validation':
             ds = ds.take(1024)
-        return self.get_dataloader(ds, None)#None if split == 'train' else False)
+        # only ever drop training batches, so validation loss still covers every sample
+        return self.get_dataloader(ds, None, drop_last=self.drop_last and split == 'train')#None if split == 'train' else False)
     
     def train_dataloader(self): return self.get_dataset('train')
     def val_dataloader(self): return self.get_dataset('validation')
@@ -97,8 +97,12 @@ class CoreLightningTrainer(cli.ITrainer):
 
         trainer : lightning.Trainer = self.lightning_trainer_factory(num_sanity_val_steps=0)#, enable_progress_bar=False)#num_sanity_val_steps=1)
         if cfg.compile:
+            # NOTE - torch.compile is lazy, so this only catches setup errors; graph breaks under compile_fullgraph raise at the first step
             try:
-                lightning_model.model = torch.compile(lightning_model.model)
+                if cfg.compile_max_autotune_gemm:
+                    import torch._inductor.config
+                    torch._inductor.config.max_autotune_gemm = True
+                lightning_model.model = torch.compile(lightning_model.model, mode=cfg.compile_mode, fullgraph=cfg.compile_fullgraph, dynamic=cfg.compile_dynamic)
             except Exception as e:
                 print(f"Skipping torch.compile due to error: {e}")
 
@@ -241,6 +245,10 @@ class CoreLightningModel(LightningModule):
         else:
             return dict(optimizer=optimizer, lr_scheduler=self.scheduler_config.to_dict(optimizer))
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer):
+        # drop the grads instead of launching a kernel to zero each one
+        optimizer.zero_grad(set_to_none=True)
+
     def _get_loss_logits_preds(self, batch, batch_idx):
         x, y = batch
         logits = self(x)
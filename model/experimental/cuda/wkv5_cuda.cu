@@ -0,0 +1,71 @@
+#include <stdio.h>
+#include <assert.h>
+#include <ATen/cuda/CUDAContext.h>
+
+// one block per (b,h), one thread per value channel j
+// k and v may have fewer heads than r for grouped-query attention, with head h reading k/v head h / (H / KVH)
+// each thread owns column j of the KxV state, which lives in shared memory for the whole T loop
+__global__ void kernel_forward(const int H, const int KVH, const int T, const int K, const int V, const int w_stride_b,
+                               const float *__restrict__ const _r, const float *__restrict__ const _k, const float *__restrict__ const _v,
+                               const float *__restrict__ const _w, const float *__restrict__ const _u,
+                               float *__restrict__ const _s, float *__restrict__ const _y)
+{
+    const int bh = blockIdx.x;
+    const int b = bh / H;
+    const int h = bh % H;
+    const int j = threadIdx.x;
+    const int bkvh = b * KVH + h / (H / KVH);
+
+    extern __shared__ float smem[];
+    float *r = smem;        // K
+    float *k = r + K;       // K
+    float *w = k + K;       // K
+    float *u = w + K;       // K
+    float *state = u + K;   // KxV
+
+    const float *rp = _r + bh * T * K;
+    const float *kp = _k + bkvh * T * K;
+    const float *vp = _v + bkvh * T * V;
+    const float *wp = _w + b * w_stride_b + h * T * K;
+    float *yp = _y + bh * T * V;
+    float *sp = _s + bh * K * V;
+
+    for (int i = j; i < K; i += blockDim.x)
+        u[i] = _u[h * K + i];
+    for (int i = 0; i < K; i++)
+        state[i * V + j] = sp[i * V + j];
+    __syncthreads();
+
+    for (int t = 0; t < T; t++)
+    {
+        for (int i = j; i < K; i += blockDim.x)
+        {
+            r[i] = rp[t * K + i];
+            k[i] = kp[t * K + i];
+            w[i] = wp[t * K + i];
+        }
+        __syncthreads();
+
+        const float vv = vp[t * V + j];
+        float y = 0;
+        for (int i = 0; i < K; i++)
+        {
+            const float kv = k[i] * vv;
+            const float s = state[i * V + j];
+            y += r[i] * (u[i] * kv + s);
+            state[i * V + j] = s * w[i] + kv;
+        }
+        yp[t * V + j] = y;
+        __syncthreads();
+    }
+
+    for (int i = 0; i < K; i++)
+        sp[i * V + j] = state[i * V + j];
+}
+
+void cuda_forward(int B, int H, int KVH, int T, int K, int V, int w_stride_b, const float *r, const float *k, const float *v, const float *w, const float *u, float *s, float *y)
+{
+    assert(V <= 1024);
+    const size_t smem_size = (4 * K + K * V) * sizeof(float);
+    kernel_forward<<<B * H, V, smem_size, at::cuda::getCurrentCUDAStream()>>>(H, KVH, T, K, V, w_stride_b, r, k, v, w, u, s, y);
+}
@@ -0,0 +1,28 @@
+#include <torch/extension.h>
+#include <c10/cuda/CUDAGuard.h>
+
+void cuda_forward(int B, int H, int KVH, int T, int K, int V, int w_stride_b, const float *r, const float *k, const float *v, const float *w, const float *u, float *s, float *y);
+
+// expects contiguous float32 CUDA tensors
+// r : (B,H,T,K), k : (B,KVH,T,K), v : (B,KVH,T,V), w : (B,H,T,K) or (1,H,T,K), u : (H,K), s : (B,H,K,V)
+// returns y : (B,H,T,V) and the updated state s : (B,H,K,V)
+std::vector<torch::Tensor> forward(torch::Tensor r, torch::Tensor k, torch::Tensor v, torch::Tensor w, torch::Tensor u, torch::Tensor s) {
+    TORCH_CHECK(r.is_cuda() && k.is_cuda() && v.is_cuda() && w.is_cuda() && u.is_cuda() && s.is_cuda(), "wkv5: all inputs must be CUDA tensors");
+    TORCH_CHECK(r.is_contiguous() && k.is_contiguous() && v.is_contiguous() && w.is_contiguous() && u.is_contiguous() && s.is_contiguous(), "wkv5: all inputs must be contiguous");
+    TORCH_CHECK(r.scalar_type() == torch::kFloat32, "wkv5: inputs must be float32");
+
+    const at::cuda::OptionalCUDAGuard device_guard(device_of(r));
+
+    const int B = r.size(0), H = r.size(1), KVH = k.size(1), T = r.size(2), K = r.size(3), V = v.size(3);
+    TORCH_CHECK(H % KVH == 0, "wkv5: the number of k/v heads must divide the number of heads");
+    const int w_stride_b = w.size(0) == 1 ? 0 : H * T * K;
+
+    auto y = torch::empty({B, H, T, V}, r.options());
+    auto s_out = s.clone();
+    cuda_forward(B, H, KVH, T, K, V, w_stride_b, r.data_ptr<float>(), k.data_ptr<float>(), v.data_ptr<float>(), w.data_ptr<float>(), u.data_ptr<float>(), s_out.data_ptr<float>(), y.data_ptr<float>());
+    return {y, s_out};
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("forward", &forward, "wkv5 forward (CUDA)");
+}
@@ -22,19 +22,27 @@ import torch.nn.functional as F
 from torch import Tensor
 
 from .rwkv_inner import rwkv_inner
+from .rwkv5_cuda import rwkv5_wkv_available, rwkv5_wkv_forward
 
-def rwkv5_1_recurrent(r_in, k_in, v_in, w_in, u, kv_state):
-    L = r_in.size(-2)
-    out = []
-    for t in range(L):
-        r, k, v, w = r_in[...,t:t+1,:], k_in[...,t:t+1,:], v_in[...,t:t+1,:], w_in[...,t:t+1,:]
-        kv = k.mT @ v # KV
-        out.append( r @ (kv_state + u.mT * kv) ) # 1K @ (KV + 1)
-        kv_state = (w.mT * kv_state) + kv # KV
-    out = torch.cat(out, dim=-2)
-    return out, kv_state
+def rwkv5_recurrent(r, k, v, w, u, kv_state):
+    # the full recurrence as a single torch.ops.rwkv5.wkv_forward kernel launch when it applies, otherwise rwkv_inner with one step per chunk
+    if rwkv5_wkv_available(r, k, v, w, u, kv_state):
+        return rwkv5_wkv_forward(r, k, v, w, u, kv_state)
+    return rwkv_inner(r, k, v, w, u, kv_state, chunk_len=1)
 
 def sanity_check():
+    # per timestep python loop, only here to check the fast paths against
+    def _reference_recurrent(r_in, k_in, v_in, w_in, u, kv_state):
+        L = r_in.size(-2)
+        out = []
+        for t in range(L):
+            r, k, v, w = r_in[...,t:t+1,:], k_in[...,t:t+1,:], v_in[...,t:t+1,:], w_in[...,t:t+1,:]
+            kv = k.mT @ v # KV
+            out.append( r @ (kv_state + u.mT * kv) ) # 1K @ (KV + 1)
+            kv_state = (w.mT * kv_state) + kv # KV
+        out = torch.cat(out, dim=-2)
+        return out, kv_state
+
     T = 4
     B = 1
     H = 1
@@ -51,13 +59,36 @@ def sanity_check():
     w = w.clamp(precision_min_val)
 
     # recurrent
-    out, _ = rwkv5_1_recurrent(r,k,v,w,u,kv_state)
+    out, _ = _reference_recurrent(r,k,v,w,u,kv_state)
+    print(out)
+
+    # recurrent fast path
+    out, _ = rwkv5_recurrent(r,k,v,w,u,kv_state)
     print(out)
 
     # parallel
     out, _ = rwkv_inner(r,k,v,w,u,kv_state,chunk_len=2)
     print(out)
 
+    # parallel with analytic per head decay
+    out, _ = rwkv_inner(r,k,v,None,u,kv_state,chunk_len=2,w_log_scalar=w[0,:,0,0].log())
+    print(out)
+
+    # grouped-query attention from an implicit zero state, with k, v and the decays given per k/v head
+    H, KVH = 4, 2
+    G = H // KVH
+    r = torch.rand(B,H,T,K)
+    k = torch.rand(B,KVH,T,K)
+    v = torch.rand(B,KVH,T,V)
+    w_log = torch.rand(KVH).clamp(precision_min_val).log()
+    u = torch.rand(1,KVH,1,K)
+    w = w_log.exp().view(1,KVH,1,1).expand(B,KVH,T,K)
+    out_ref, s_ref = _reference_recurrent(r,k.repeat_interleave(G,1),v.repeat_interleave(G,1),w.repeat_interleave(G,1),u.repeat_interleave(G,1),torch.zeros(B,H,K,V))
+    out, s = rwkv_inner(r,k,v,None,u,None,chunk_len=2,w_log_scalar=w_log)
+    print("GQA zero state out max error", (out - out_ref).abs().max().item(), "state max error", (s - s_ref).abs().max().item())
+    out, s = rwkv_inner(r,k,v,w,u,None,chunk_len=2)
+    print("GQA zero state (per token w) out max error", (out - out_ref).abs().max().item(), "state max error", (s - s_ref).abs().max().item())
+
 if __name__ == "__main__":
     sanity_check()
     exit()
@@ -119,7 +150,8 @@ class RWKV5_1_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
                 tmp[h] = ratio_0_to_1 * (1 - (h / max(self.n_kv_head - 1, 1)))
             self.time_faaaa = nn.Parameter(tmp) # (KVH)
 
-        self.time_shift = nn.ZeroPad2d((0, 0, 1, -1))
+        self._decay_and_bonus_cache = None
+
         self.receptance = nn.Linear(args.n_embd, self.n_head * self.r_head_size, bias=False)
         self.key = nn.Linear(args.n_embd, self.n_kv_head * self.k_head_size, bias=False)
         self.value = nn.Linear(args.n_embd, self.n_kv_head * self.v_head_size, bias=False)
@@ -128,7 +160,8 @@ class RWKV5_1_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
 
         self.rotary_positional_embedding = hparams.rotary_positional_embedding_factory(hparams.max_sequence_length, int(hparams.d_qk_ratio * hparams.d_model / hparams.n_head))
 
-        self.ln_x = nn.GroupNorm(self.n_kv_head, args.dim_v)
+        # GroupNorm(x / d, eps) == GroupNorm(x, eps * d^2), so fold head_size_divisor into eps instead of dividing the activations every forward
+        self.ln_x = nn.GroupNorm(self.n_kv_head, args.dim_v, eps=1e-5 * args.head_size_divisor ** 2)
 
     def post_init_fn(self, myself):
         zero = [self.receptance, self.key, self.output]
@@ -143,6 +176,34 @@ class RWKV5_1_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
                 gain = 1.0
             nn.init.orthogonal_(m.weight, gain=gain)
 
+    def _mix(self, x : Tensor):
+        # Mix x with the previous timestep to produce kx, vx, rx, gx
+        # lerp(xx, x, m) == x * m + xx * (1 - m) as a single fused op, rather than four separate multiply-adds per mix
+        xx = F.pad(x, (0, 0, 1, 0))[:, :-1] # time shift
+        kx = torch.lerp(xx, x, self.time_mix_k)
+        vx = torch.lerp(xx, x, self.time_mix_v)
+        rx = torch.lerp(xx, x, self.time_mix_r)
+        gx = torch.lerp(xx, x, self.time_mix_g)
+        return kx, vx, rx, gx
+
+    def _decay_and_bonus(self):
+        # the decay is constant per head, so hand rwkv_inner log(w) = -exp(time_decay) and let it compute the cumulative decays analytically
+        # both values depend only on parameters, so outside of autograd and torch.compile they are cached until an in-place update
+        #  (optimizer step, load_state_dict, .to) bumps the parameters' version counters
+        K = self.k_head_size
+        reps = self.n_head // self.n_kv_head
+        use_cache = not torch.is_grad_enabled() and not torch.compiler.is_compiling()
+        if use_cache:
+            key = (self.time_decay._version, self.time_faaaa._version, self.time_decay.data_ptr(), self.time_faaaa.data_ptr())
+            if self._decay_and_bonus_cache is not None and self._decay_and_bonus_cache[0] == key:
+                return self._decay_and_bonus_cache[1]
+        # under grouped-query attention query head h has always used decay and bonus h % KVH, so tile them up to H heads to keep trained checkpoints unchanged
+        w_log = -torch.exp(self.time_decay.float()).repeat(reps) # (H)
+        u = self.time_faaaa.float().repeat(reps).view(1,-1,1,1).expand(1,-1,1,K) # (1,H,1,K)
+        if use_cache:
+            self._decay_and_bonus_cache = (key, (w_log, u))
+        return w_log, u
+
     def forward(self, xq : Tensor, xk : Tensor, xv : Tensor, recurrent_memory : Optional[Tensor] = None):
         x = xq # FIXME - support encoder-decoder models
 
@@ -162,43 +223,27 @@ class RWKV5_1_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
 
         B, T, C = x.size()
 
-        xx = self.time_shift(x) # Mix x with the previous timestep to produce kx, vx, rx, gx
-        kx = x * self.time_mix_k + xx * (1 - self.time_mix_k)
-        vx = x * self.time_mix_v + xx * (1 - self.time_mix_v)
-        rx = x * self.time_mix_r + xx * (1 - self.time_mix_r)
-        gx = x * self.time_mix_g + xx * (1 - self.time_mix_g)
+        kx, vx, rx, gx = self._mix(x)
 
         r = self.receptance(rx).view(B, T, H, K).transpose(1, 2) # BHTK
-        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # BHTK
-        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # BHTV
+        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # B(KVH)TK
+        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # B(KVH)TV
         g = F.silu(self.gate(gx))
         
         r, k = self.rotary_positional_embedding((r, k))
 
-        # support for grouped-query attention
-        # if there are fewer k/v heads than total heads, repeat them until the number matches
-        time_decay = self.time_decay.float() # (KVH)
-        time_faaaa = self.time_faaaa.float() # (KVH)
-        if KVH < H:
-            reps = H // KVH
-            k = k[:,:,None,:,:].expand(B, KVH, reps, T, K).contiguous().view(B, H, T, K)
-            v = v[:,:,None,:,:].expand(B, KVH, reps, T, V).contiguous().view(B, H, T, V)
-            time_decay = time_decay.expand(reps, KVH).contiguous().view(H)
-            time_faaaa = time_faaaa.expand(reps, KVH).contiguous().view(H)
+        # k and v are left at KVH heads for rwkv_inner to broadcast across each group of query heads, instead of being repeated in memory
+        w_log, u = self._decay_and_bonus()
 
+        # without recurrent memory the state starts at zero, which rwkv_inner handles without us allocating and reading a zero tensor
         kv_state = recurrent_memory
-        if kv_state is None:
-            kv_state = torch.zeros(B, H, K, V, device=r.device, dtype=r.dtype)  # state
-
-        if kv_state.dtype != r.dtype:
+        if kv_state is not None and kv_state.dtype != r.dtype:
             kv_state = kv_state.contiguous().to(r.dtype) 
 
-        w = torch.exp(-torch.exp(time_decay)).view(1,H,1,1).expand(1,H,T,K)
-        u = time_faaaa.view(1,H,1,1).expand(1,H,1,K)
-        out, s = rwkv_inner(r, k, v, w, u, kv_state, chunk_len)
+        out, s = rwkv_inner(r, k, v, None, u, kv_state, chunk_len, w_log_scalar=w_log)
 
         out = out.transpose(1,2).reshape(B*T, H*V)
-        out = self.ln_x(out / self.args.head_size_divisor).view(B, T, H*V)
+        out = self.ln_x(out).view(B, T, H*V)
 
         out = self.output(out * g)        
 
@@ -172,22 +172,19 @@ class RWKV5_2_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
         gx = x * self.time_mix_g + xx * (1 - self.time_mix_g)
 
         r = self.receptance(rx).view(B, T, H, K).transpose(1, 2) # BHTK
-        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # BHTK
-        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # BHTV
+        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # B(KVH)TK
+        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # B(KVH)TV
         g = F.silu(self.gate(gx))
         
         r, k = self.rotary_positional_embedding((r, k))
 
-        # support for grouped-query attention
-        # if there are fewer k/v heads than total heads, repeat them until the number matches
+        # k and v stay at KVH heads, rwkv_inner broadcasts each one across its group of H // KVH query heads without copying it
         time_decay = self.time_decay.float() # (KVH,K)
         time_faaaa = self.time_faaaa.float() # (KVH,K)
         if KVH < H:
-            reps = H // KVH
-            k = k[:,:,None,:,:].expand(B, KVH, reps, T, K).contiguous().view(B, H, T, K)
-            v = v[:,:,None,:,:].expand(B, KVH, reps, T, V).contiguous().view(B, H, T, V)
-            time_decay = time_decay.expand(reps, KVH, K).contiguous().view(H, K)
-            time_faaaa = time_faaaa.expand(reps, KVH, K).contiguous().view(H, K)
+            # query head h has always used decay and bonus row h % KVH, so tile the rows up to H heads rather than change what trained checkpoints compute
+            time_decay = time_decay.repeat(H // KVH, 1) # (H,K)
+            time_faaaa = time_faaaa.repeat(H // KVH, 1) # (H,K)
 
         kv_state = recurrent_memory
         if kv_state is None:
@@ -197,7 +194,7 @@ class RWKV5_2_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
             kv_state = kv_state.contiguous().to(r.dtype) 
 
         w = torch.exp(-torch.exp(time_decay)).view(1,H,1,K).expand(1,H,T,K)
-        u = time_faaaa.float().view(1,H,1,K)
+        u = time_faaaa.view(1,H,1,K)
         out, s = rwkv_inner(r, k, v, w, u, kv_state, chunk_len)
 
         out = out.transpose(1,2).reshape(B*T, H*V)
@@ -0,0 +1,83 @@
+import os
+
+import torch
+
+from torch import Tensor
+
+# the kernel keeps the whole KxV state in shared memory, so it only applies up to this size
+_WKV5_CUDA_MAX_SHARED_MEM_BYTES = 48 * 1024
+
+_wkv5_cuda = None
+_wkv5_cuda_load_failed = False
+
+def _load_wkv5_cuda():
+    # compile lazily on first use, so importing this module never requires nvcc
+    global _wkv5_cuda, _wkv5_cuda_load_failed
+    if _wkv5_cuda is None and not _wkv5_cuda_load_failed:
+        try:
+            from torch.utils.cpp_extension import load
+            cuda_dir = os.path.join(os.path.dirname(__file__), 'cuda')
+            _wkv5_cuda = load(name='wkv5', sources=[os.path.join(cuda_dir, 'wkv5_op.cpp'), os.path.join(cuda_dir, 'wkv5_cuda.cu')], extra_cuda_cflags=['-O3'], verbose=False)
+        except Exception as e:
+            print(f"Skipping wkv5 CUDA kernel due to error: {e}")
+            _wkv5_cuda_load_failed = True
+    return _wkv5_cuda
+
+# registered as torch.ops.rwkv5.wkv_forward so torch.compile treats the kernel as one opaque op instead of graph breaking on the extension call
+# expects contiguous float32 inputs, with w and u already given per head (see wkv5_op.cpp)
+_lib = torch.library.Library('rwkv5', 'DEF')
+_lib.define('wkv_forward(Tensor r, Tensor k, Tensor v, Tensor w, Tensor u, Tensor kv_state) -> (Tensor, Tensor)')
+
+def _wkv_forward_cuda(r : Tensor, k : Tensor, v : Tensor, w : Tensor, u : Tensor, kv_state : Tensor):
+    out, s = _load_wkv5_cuda().forward(r, k, v, w, u, kv_state)
+    return out, s
+
+def _wkv_forward_meta(r : Tensor, k : Tensor, v : Tensor, w : Tensor, u : Tensor, kv_state : Tensor):
+    B, H, T, K = r.size()
+    return r.new_empty(B, H, T, v.size(-1)), torch.empty_like(kv_state)
+
+_lib.impl('wkv_forward', _wkv_forward_cuda, 'CUDA')
+_lib.impl('wkv_forward', _wkv_forward_meta, 'Meta')
+
+def _repeat_heads(x : Tensor, H : int):
+    # expand a tensor given per k/v head (A,KVH,...) to one entry per head (A,H,...), with head h using k/v head h // (H // KVH)
+    if x.size(1) == H:
+        return x
+    A, KVH = x.size(0), x.size(1)
+    return x.unsqueeze(2).expand(A, KVH, H // KVH, *x.shape[2:]).reshape(A, H, *x.shape[2:])
+
+def rwkv5_wkv_available(r : Tensor, k : Tensor, v : Tensor, w : Tensor, u : Tensor, kv_state : Tensor):
+    # forward only, so never use it when gradients are required
+    if not r.is_cuda:
+        return False
+    if torch.is_grad_enabled() and any(t.requires_grad for t in (r, k, v, w, u, kv_state)):
+        return False
+    K, V = k.size(-1), v.size(-1)
+    if V > 1024 or (4 * K + K * V) * 4 > _WKV5_CUDA_MAX_SHARED_MEM_BYTES:
+        return False
+    return _load_wkv5_cuda() is not None
+
+def rwkv5_wkv_forward(r : Tensor, k : Tensor, v : Tensor, w : Tensor, u : Tensor, kv_state : Tensor):
+    """
+    runs the full rwkv5 recurrence over all L timesteps in a single CUDA kernel launch
+    expects
+    r : (B,H,L,K)
+    k : (B,KVH,L,K)
+    v : (B,KVH,L,V)
+    w : (B,H,L,K) or (1,H,L,K) or (B,KVH,L,K) or (1,KVH,L,K)
+    u : (1,H,1,K) or (1,KVH,1,K)
+    kv_state : (B,H,K,V)
+    returns
+    out : (B,H,L,V)
+    kv_state : (B,H,K,V)
+    """
+    B,H,L,K = r.size()
+    out, s = torch.ops.rwkv5.wkv_forward(
+        r.float().contiguous(),
+        k.float().contiguous(),
+        v.float().contiguous(),
+        _repeat_heads(w.float().expand(-1,-1,L,K), H).contiguous(),
+        _repeat_heads(u.float().expand(-1,-1,1,K), H).reshape(H,K).contiguous(),
+        kv_state.float().contiguous(),
+    )
+    return out.to(r.dtype), s.to(kv_state.dtype)
@@ -208,22 +208,20 @@ class RWKV6_0_AttentionSubLayer(model.core.TransformerLayerPart, model.interface
         gx = xx + sx * (self.g_maa + mg)
 
         r = self.receptance(rx).view(B, T, H, K).transpose(1, 2) # BHTK
-        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # BHTK
-        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # BHTV
+        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # B(KVH)TK
+        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # B(KVH)TV
         g = F.silu(self.gate(gx))
 
         r, k = self.rotary_positional_embedding((r, k))
 
-        # support for grouped-query attention
-        # if there are fewer k/v heads than total heads, repeat them until the number matches
+        # rwkv_inner takes k and v at KVH heads and shares each across the query heads of its group, so they are not repeated here
         time_decay = self.time_decay.float() # (KVH,K)
         time_first = self.time_first.float() # (KVH,K)
         if KVH < H:
-            reps = H // KVH
-            k = k[:,:,None,:,:].expand(B, KVH, reps, T, K).contiguous().view(B, H, T, K)
-            v = v[:,:,None,:,:].expand(B, KVH, reps, T, V).contiguous().view(B, H, T, V)
-            time_decay = time_decay.expand(reps, KVH, K).contiguous().view(H, K)
-            time_first = time_first.expand(reps, KVH, K).contiguous().view(H, K)
+            # the decay lora below is per query head, and head h has always used time_decay and time_first row h % KVH,
+            #  so tile both up to H heads to keep trained checkpoints computing the same thing
+            time_decay = time_decay.repeat(H // KVH, 1) # (H,K)
+            time_first = time_first.repeat(H // KVH, 1) # (H,K)
 
         kv_state = recurrent_memory
         if kv_state is None:
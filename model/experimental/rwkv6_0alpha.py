@@ -142,23 +142,21 @@ class RWKV6_0_Alpha_AttentionSubLayer(model.core.TransformerLayerPart, model.int
         gx = xx + sx * (self.g_maa + mg)
 
         r = self.receptance(rx).view(B, T, H, K).transpose(1, 2) # BHTK
-        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # BHTK
-        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # BHTV
+        k = self.key(kx).view(B, T, KVH, K).transpose(1, 2)      # B(KVH)TK
+        v = self.value(vx).view(B, T, KVH, V).transpose(1, 2)    # B(KVH)TV
         g = self.gate(gx)
 
         # rotate queries and keys via RoPE / XPos
         r, k = self.rotary_positional_embedding((r, k))
 
-        # support for grouped-query attention
-        # if there are fewer k/v heads than total heads, repeat them until the number matches
+        # no repeat of k and v for grouped-query attention, rwkv_inner broadcasts them across each group of H // KVH query heads
         time_decay = self.time_decay.float() # (KVH,K)
         time_first = self.time_first.float() # (KVH,K)
         if KVH < H:
-            reps = H // KVH
-            k = k[:,:,None,:,:].expand(B, KVH, reps, T, K).contiguous().view(B, H, T, K)
-            v = v[:,:,None,:,:].expand(B, KVH, reps, T, V).contiguous().view(B, H, T, V)
-            time_decay = time_decay.expand(reps, KVH, K).contiguous().view(H, K)
-            time_first = time_first.expand(reps, KVH, K).contiguous().view(H, K)
+            # time_decay gets a per query head lora term added below, and like time_first its rows have always mapped to head h % KVH,
+            #  so tile them to (H,K) instead of remapping heads on existing checkpoints
+            time_decay = time_decay.repeat(H // KVH, 1) # (H,K)
+            time_first = time_first.repeat(H // KVH, 1) # (H,K)
 
         kv_state = recurrent_memory
         if kv_state is None:
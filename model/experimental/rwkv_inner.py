@@ -1,113 +1,234 @@
+from typing import Optional
+
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from torch import Tensor
 
-# 24 is optimal chunk length (longer will use too much memory and cause precision problems or even numerical instability, shorter is inefficient)
-def rwkv_inner(r,k,v,w,u,kv_state,chunk_len:int=24,precision_dtype:torch.dtype=torch.float32):
+from .rwkv5_cuda import rwkv5_wkv_available, rwkv5_wkv_forward
+from .rwkv_inner_reference import wkv_intra_chunk_reference
+from .rwkv_inner_triton import _has_triton, WKVIntraChunk
+
+def _linear_scan(a : Tensor, b : Tensor, dim : int):
     """
-    expects
-    r : (B,H,L,K)
-    k : (B,H,L,K)
-    v : (B,H,L,V)
-    w : (B,H,L,K) or (1,H,L,K)
-    u : (1,H,1,K)
-    kv_state : (B,H,K,V)
+    inclusive scan along dim of the linear recurrence x[i] = x[i-1] * a[i] + b[i], starting from x[-1] = 0
+    work efficient (Blelloch style) recursion on the associative combine (a1,b1),(a2,b2) -> (a1*a2, b1*a2 + b2):
+    combine adjacent pairs, scan the half length sequence of pairs, then fill in the even positions from their odd neighbours
+    so it does O(N) work in 2*log2(N) parallel steps, and under autograd only keeps about 2x the N intermediates a sequential loop would
+    returns the cumulative products of a, and x
     """
-    B,H,L,K = k.size()
+    dim = dim % b.dim()
+    N = b.size(dim)
+    if N == 1:
+        return a, b
+    M = N // 2
+    a_pairs = a.narrow(dim, 0, 2 * M).unflatten(dim, (M, 2))
+    b_pairs = b.narrow(dim, 0, 2 * M).unflatten(dim, (M, 2))
+    a_even, a_odd = a_pairs.select(dim + 1, 0), a_pairs.select(dim + 1, 1)
+    b_even, b_odd = b_pairs.select(dim + 1, 0), b_pairs.select(dim + 1, 1)
+
+    # results at the odd positions 1, 3, 5, ...
+    a_odd_cum, b_odd_cum = _linear_scan(a_even * a_odd, b_even * a_odd + b_odd, dim)
+
+    # results at the even positions 0, 2, 4, ... each combine the odd result before it with their own element
+    a_even_tail = a_even.narrow(dim, 1, M - 1)
+    a_even_cum = torch.cat([a_even.narrow(dim, 0, 1), a_odd_cum.narrow(dim, 0, M - 1) * a_even_tail], dim=dim)
+    b_even_cum = torch.cat([b_even.narrow(dim, 0, 1), b_odd_cum.narrow(dim, 0, M - 1) * a_even_tail + b_even.narrow(dim, 1, M - 1)], dim=dim)
+
+    # interleave even and odd results back into sequence order
+    a_cum = torch.stack([a_even_cum, a_odd_cum], dim=dim + 1).flatten(dim, dim + 1)
+    b_cum = torch.stack([b_even_cum, b_odd_cum], dim=dim + 1).flatten(dim, dim + 1)
+    if N % 2 == 1:
+        a_last, b_last = a.narrow(dim, N - 1, 1), b.narrow(dim, N - 1, 1)
+        b_cum = torch.cat([b_cum, b_cum.narrow(dim, N - 2, 1) * a_last + b_last], dim=dim)
+        a_cum = torch.cat([a_cum, a_cum.narrow(dim, N - 2, 1) * a_last], dim=dim)
+    return a_cum, b_cum
+
+def _bmm(a : Tensor, b : Tensor):
+    # flatten all batch dims so cuBLAS sees a single batched gemm (and can pick its tensor core kernels for bf16)
+    #  transposed operands stay views, since bmm handles those through its transpose flags rather than needing a copy
+    if a.shape[:-2] != b.shape[:-2]:
+        # bmm can't broadcast, and flattening an expanded operand would copy it, so let einsum fold the broadcast dims into the matmul instead
+        return torch.einsum('...ik,...kj->...ij', a, b)
+    a2 = a.reshape(-1, a.size(-2), a.size(-1))
+    b2 = b.reshape(-1, b.size(-2), b.size(-1))
+    return torch.bmm(a2, b2).view(*a.shape[:-1], b.size(-1))
+
+def wkv_intra_chunk(q : Tensor, k : Tensor, d : Tensor, v : Tensor):
+    # fused on CUDA so the (T,T) attention matrix is never written to global memory
+    if q.is_cuda and _has_triton and q.dtype in (torch.float32, torch.float16, torch.bfloat16):
+        return WKVIntraChunk.apply(q, k, d, v)
+    return wkv_intra_chunk_reference(q, k, d, v)
+
+def _chunked_decays(w : Tensor, KVH : int, N : int, T : int, precision_dtype : torch.dtype, precision_min_val : float, dtype : torch.dtype):
+    w = w.clamp(precision_min_val)
+    K = w.size(-1)
+
+    # calculate cumulative decay in log space where it won't overflow
+    w_log = w.float().log() # (1,H,L,K) or (B,H,L,K)
+
+    # chunked view of w_log, grouped by k/v head (the group axis is 1 when w is given per k/v head)
+    wc_log = w_log.view(w.size(0),KVH,-1,N,T,K)
+    wc_log_cum = wc_log.cumsum(dim=-2)
+
+    # chunked view of shifted_w_log
+    shifted_wc_log_cum = F.pad(wc_log_cum, (0, 0, 1, -1))
+
+
+    # NOTE - we have to apply the decay weight from TWO ahead.. ONE ahead gets no decay (log==0)
+    # pre-applied weights
+    # left side is prior chunk (w_inter), right side is current chunk (w_intra)
+    # without u...
+    # w0   w1   w2   w3   | w4   w5   w6   w7          
+    # w1:4 w2:4 w3:4 w4:4 | w4:5 w4:6 w4:7 w4:8
+    # with u...
+    # w0   w1   w2   w3   | w4   w5   w6   w7          
+    # w1:4 w2:4 w3:4 w4:4 | w4:4 w4:5 w4:6 w4:7
+
+    # ws decays the entire current state (representing t-1) to the prior block (t-2)
+    ws = wc_log.sum(dim=-2, keepdim=True) # 1HGN1K or BHGN1K
+    # w_inter is the decay to the end of the current block, since it will be applied at the next iteration when current (t) becomes prior (t-1)
+    # this formula because e.g. w1:4 = w0:4 - w0:1
+    w_inter = ws - wc_log_cum # 1HGNTK or BHGNTK (w^(T-1) ... w^0)
+    # w_intra is the decay from the beginning of the current block (t), since it will be applied to current queries (t) against prior state (representing keys+values up to but not including block t)
+    # this formula because e.g. w1:3 = w0:3 - w0
+    w_intra = wc_log_cum - wc_log # 1HGNTK or BHGNTK (w^0 ... w^(T-2))
+
+    ws = ws.mT.exp().to(dtype) # 1HGNK1 or BHGNK1 !!NOTE THE .mT HERE!!
+    w_inter = w_inter.exp().to(dtype) # 1HGNTK or BHGNTK
+    w_intra = w_intra.exp().to(dtype) # 1HGNTK or BHGNTK
+
+    # decays applied to r and k for the intra-chunk attention, relative to the middle of the chunk so neither side overflows
+    wc_log_offset = shifted_wc_log_cum[...,T//2:T//2+1,:] # B,H,G,N,1,K
+    r_decay = (shifted_wc_log_cum - wc_log_offset).to(precision_dtype).exp() # B,H,G,N,T,K
+    k_inv_decay = (wc_log_offset - wc_log_cum).to(precision_dtype).exp() # B,H,G,N,T,K
+    return ws, w_inter, w_intra, r_decay, k_inv_decay
+
+# neither specialization is compiled here, so eager configs and CPU stay eager and varying L / B never force recompiles
+#  when the config sets compile=True the model level torch.compile traces through both and fuses their pointwise ops
+def _rwkv_inner_step(r,k,v,w,u,kv_state):
+    B,H,L,K = r.size()
+    KVH = k.size(1)
+    V = v.size(-1)
+
+    # grouped view, with the G=H//KVH query heads that share each k/v head on their own axis
+    r = r.view(B,KVH,-1,1,K) # BHG1K
+    u = u.expand(-1,-1,-1,K).reshape(1,KVH,-1,1,K) # 1HG1K or 1H11K
+    w = w.expand(-1,-1,-1,K).reshape(w.size(0),KVH,-1,1,K) # BHG1K or BH11K
+    kv_state = kv_state.view(B,KVH,-1,K,V) # BHGKV
+
+    # for a single step the outer product and the 1xK @ KxV product are too small for cuBLAS to be worth a launch each,
+    #  so write them as broadcasts and a reduction that inductor fuses with the state update into a couple of kernels
+    kv = (k.mT * v).unsqueeze(2) # BH1KV
+    out = (r.mT * (kv_state + u.mT * kv)).sum(-2, keepdim=True) # BHG1V
+    kv_state = w.mT * kv_state + kv # BHGKV
+    return out.view(B,H,L,V), kv_state.view(B,H,K,V)
+
+def _rwkv_inner_chunked(r,k,v,w,u,kv_state,chunk_len:int,precision_dtype:torch.dtype,w_log_scalar:Optional[Tensor]):
+    B,H,L,K = r.size()
+    KVH = k.size(1)
     V = v.size(-1)
     T = chunk_len
+    N = L // T
+
+    # this has to be done to avoid numerical instability (inf/NaN) when w is used as a divisor up to chunk_length//2 places away (so precision_min_val^(T//2) has to be in fp range)
+    # NOTE - this does not account for the impact of the size of R, K so we currently use the chunk_len=32 numbers for chunk_len=24
+    assert(precision_dtype == torch.float32 or precision_dtype == torch.float64 or precision_dtype == torch.bfloat16)
+    if precision_dtype == torch.float32:
+        precision_min_val = 0.005 # good for fp32 (1.175e-38 ^ (1/16.0) < 0.00426)
+    elif precision_dtype == torch.bfloat16:
+        precision_min_val = 0.02 # bf16 has the same exponent range as fp32, but only 8 bits of mantissa so stay further from the edge (0.02 ^ 16 = 6.5e-28)
+    else: #elif precision_dtype == torch.float64:
+        precision_min_val = 1e-10 # good for fp64 (1.7e-308 ^ (1/16.0) < 5.8e-20)
+
+    if w_log_scalar is not None:
+        # w is constant along L and K, so every cumulative decay below is just a multiple of the per head log decay
+        #  and we can compute them directly from a (T,) offset table instead of building, logging and summing a (1,H,L,K) w
+        w_log = w_log_scalar.float().clamp(math.log(precision_min_val)).view(1,KVH,-1,1,1,1) # 1HG111 or 1H1111
+        t = torch.arange(T, device=w_log.device, dtype=w_log.dtype).view(T,1) # T1
+        ws = (w_log * T).exp().to(r.dtype).expand(-1,-1,-1,N,-1,-1) # 1HGN11 or 1H1N11
+        w_inter = ((T - 1 - t) * w_log).exp().to(r.dtype) # 1HG1T1 or 1H11T1 (w^(T-1) ... w^0)
+        w_intra = (t * w_log).exp().to(r.dtype) # 1HG1T1 or 1H11T1 (w^0 ... w^(T-2))
+        r_decay = ((t - T//2) * w_log).to(precision_dtype).exp() # 1HG1T1 or 1H11T1
+        k_inv_decay = ((T//2 - 1 - t) * w_log).to(precision_dtype).exp() # 1HG1T1 or 1H11T1
+    else:
+        ws, w_inter, w_intra, r_decay, k_inv_decay = _chunked_decays(w, KVH, N, T, precision_dtype, precision_min_val, r.dtype)
+
+    # chunked view of r, k, v
+    # grouped-query attention is supported natively: the G=H//KVH query heads sharing each k/v head get their own axis,
+    #  so k and v are broadcast against them instead of being repeated in memory
+    r = r.view(B,KVH,-1,N,T,K) 
+    k = k.view(B,KVH,1,N,T,K) 
+    v = v.view(B,KVH,N,T,V)
+    u = u.expand(-1,-1,-1,K).reshape(1,KVH,-1,1,1,K).to(r.dtype) # (1,H,G,1,1,K) or (1,H,1,1,1,K)
+    if kv_state is not None:
+        kv_state = kv_state.view(B,KVH,-1,K,V) # BHGKV
+
+    # parallel calculation of all intra-chunk attention contributions
+    # (tril((r*r_decay) @ (k*k_inv_decay).mT, -1) + diag(r.(u*k))) @ v, fused on CUDA so the (T,T) attention matrix is never materialized
+    out = wkv_intra_chunk(r*r_decay, k*k_inv_decay, (r * (u * k)).sum(dim=-1), v) # BHGNTV
+    # alternate way of adding in u
+    # out = out + torch.einsum('bhntk,bhntk,bhntv->bhntv', r, u * k, v) 
+
+    # parallel precalculation of chunked (k*wk).mT@v for use in recurrent state calc below
+    wkv = torch.einsum('bhgntk,bhntv->bhgnkv', k * w_inter, v) # BHGNKV
+
+    # parallel calculation of all states, equivalent to the sequential recurrence
+    #  for i in range(N): states[i] = kv_state; kv_state = kv_state * ws[i] + wkv[i]
+    # the scan runs along the chunk axis in place, so states come out already laid out for the matmul against r below
+    ws_cum, wkv_cum = _linear_scan(ws, wkv, dim=3) # 1HGNK1 or BHGNK1, BHGNKV
+    if kv_state is None:
+        # zero initial state, so the decayed initial state terms vanish and the first chunk starts from zeros
+        # NOTE - with decays given per k/v head these keep a group axis of 1, shared by every query head in the group
+        next_states = wkv_cum # BHGNKV or BH1NKV (state after each chunk)
+        states = F.pad(next_states[...,:-1,:,:], (0,0,0,0,1,0)) # BHGNKV or BH1NKV (state before each chunk)
+    else:
+        kv_state = kv_state.unsqueeze(3) # BHG1KV
+        next_states = kv_state * ws_cum + wkv_cum # BHGNKV (state after each chunk)
+        states = torch.cat([kv_state, next_states[...,:-1,:,:]], dim=3) # BHGNKV (state before each chunk)
+    kv_state = next_states[...,-1,:,:] # BHGKV or BH1KV
+
+    # parallel application of all r to states
+    out = out + _bmm(r * w_intra, states) # BHGNTV
+    out = out.reshape(B,H,L,V)
+    return out, kv_state.expand(B,KVH,r.size(2),K,V).reshape(B,H,K,V)
 
+# 24 is optimal chunk length (longer will use too much memory and cause precision problems or even numerical instability, shorter is inefficient)
+def rwkv_inner(r,k,v,w,u,kv_state,chunk_len:int=24,precision_dtype:Optional[torch.dtype]=None,w_log_scalar:Optional[Tensor]=None):
+    """
+    expects
+    r : (B,H,L,K)
+    k : (B,KVH,L,K)
+    v : (B,KVH,L,V)
+    w : (B,H,L,K) or (1,H,L,K) or (B,KVH,L,K) or (1,KVH,L,K), or None if w_log_scalar is given
+    u : (1,H,1,K) or (1,KVH,1,K)
+    kv_state : (B,H,K,V), or None to start from a zero state without allocating one
+    w_log_scalar : optional (H,) or (KVH,) log of a per head decay that is constant over L and K, used instead of w
+    where KVH divides H for grouped-query attention, query head h using k/v head h // (H // KVH)
+    precision_dtype is the dtype the decays and intra-chunk attention are computed in (float32, bfloat16 or float64)
+    and defaults to the dtype of w (or w_log_scalar), so e.g. a bf16 w keeps the whole calculation in bf16
+    """
+    L = r.size(-2)
     if L == 1:
-        kv = k @ v
-        out = r @ (kv_state + u * kv)
-        kv_state = w * kv_state + kv
-        return out, kv_state
-    else:
-        # FIXME - support fast path for non-exact multiples
-        # ensure it's an exact multiple
-        if L % T != 0:
-            T = 1
-
-        N = L // T
-
-        # this has to be done to avoid numerical instability (inf/NaN) when w is used as a divisor up to chunk_length//2 places away (so precision_min_val^(T//2) has to be in fp range)
-        # NOTE - this does not account for the impact of the size of R, K so we currently use the chunk_len=32 numbers for chunk_len=24
-        assert(precision_dtype == torch.float32 or precision_dtype == torch.float64)
-        if precision_dtype == torch.float32:
-            precision_min_val = 0.005 # good for fp32 (1.175e-38 ^ (1/16.0) < 0.00426)
-        else: #elif precision_dtype == torch.float64:
-            precision_min_val = 1e-10 # good for fp64 (1.7e-308 ^ (1/16.0) < 5.8e-20)
-        w = w.clamp(precision_min_val)
-
-        # calculate cumulative decay in log space where it won't overflow
-        w_log = w.float().log() # (1,H,L,K) or (B,H,L,K)
-
-        # chunked view of w_log
-        wc_log = w_log.view(w.size(0),H,N,T,K)
-        wc_log_cum = wc_log.cumsum(dim=-2)
-
-        # chunked view of shifted_w_log
-        shifted_wc_log_cum = F.pad(wc_log_cum, (0, 0, 1, -1))
-
-
-        # NOTE - we have to apply the decay weight from TWO ahead.. ONE ahead gets no decay (log==0)
-        # pre-applied weights
-        # left side is prior chunk (w_inter), right side is current chunk (w_intra)
-        # without u...
-        # w0   w1   w2   w3   | w4   w5   w6   w7          
-        # w1:4 w2:4 w3:4 w4:4 | w4:5 w4:6 w4:7 w4:8
-        # with u...
-        # w0   w1   w2   w3   | w4   w5   w6   w7          
-        # w1:4 w2:4 w3:4 w4:4 | w4:4 w4:5 w4:6 w4:7
-
-        # ws decays the entire current state (representing t-1) to the prior block (t-2)
-        ws = wc_log.sum(dim=-2, keepdim=True) # 1HN1K or BHN1K
-        # w_inter is the decay to the end of the current block, since it will be applied at the next iteration when current (t) becomes prior (t-1)
-        # this formula because e.g. w1:4 = w0:4 - w0:1
-        w_inter = ws - wc_log_cum # 1HNTK or BHNTK (w^(T-1) ... w^0)
-        # w_intra is the decay from the beginning of the current block (t), since it will be applied to current queries (t) against prior state (representing keys+values up to but not including block t)
-        # this formula because e.g. w1:3 = w0:3 - w0
-        w_intra = wc_log_cum - wc_log # 1HNTK or BHNTK (w^0 ... w^(T-2))
-
-        ws = list(ws.mT.exp().to(r.dtype).unbind(dim=-3)) # N x 1HK1 or BHK1 !!NOTE THE .mT HERE!!
-        w_inter = w_inter.exp().to(r.dtype) # 1HNTK or BHNTK
-        w_intra = w_intra.exp().to(r.dtype) # 1HNTK or BHNTK
-
-        # chunked view of r, k, v
-        r = r.view(B,H,N,T,K) 
-        k = k.view(B,H,N,T,K) 
-        v = v.view(B,H,N,T,V)
-        u = u.unsqueeze(2).to(r.dtype) # (1,H,1,1,K)
-
-        # parallel calculation of all intra-chunk attention contributions
-        wc_log_offset = shifted_wc_log_cum[...,T//2:T//2+1,:] # B,H,N,1,K
-        r_decay = (shifted_wc_log_cum - wc_log_offset).to(precision_dtype).exp() # B,H,N,T,K
-        k_inv_decay = (wc_log_offset - wc_log_cum).to(precision_dtype).exp() # B,H,N,T,K
-        a = ((r*r_decay) @ (k*k_inv_decay).mT).to(r.dtype).tril(-1) # B,H,N,T,T
-        # add u term to attention (NOTE - the tril(-1) above zeroed the diagonal)
-        a = a + torch.einsum('bhntk,bhntk->bhnt', r, u * k).diag_embed()
-        out = a @ v # BHNTV
-        # alternate way of adding in u
-        # out = out + torch.einsum('bhntk,bhntk,bhntv->bhntv', r, u * k, v) 
-
-        # parallel precalculation of chunked (k*wk).mT@v for use in recurrent state calc below
-        wkv = (k * w_inter).mT @ v # BHNKV
-        wkv = list(wkv.unbind(dim=-3)) # N x BHKV
-
-        # recurrent calculation of all states
-        states = []
-        for i in range(N):
-            states.append(kv_state)
-            kv_state = kv_state * ws[i] + wkv[i] # BHKV
-            # equivalent non-precalced version
-            #wkv = (k[...,i,:,:] * wk[...,i,:,:]).mT @ v[...,i,:,:]
-            #kv_state = kv_state * ws[i] + wkv
-        states = torch.stack(states, dim=2) # BHNKV       
-
-        # parallel application of all r to states
-        out = out + (r * w_intra) @ states # BHNTV
-        out = out.view(B,H,L,V)
-        return out, kv_state
-            
\ No newline at end of file
+        if kv_state is None:
+            kv_state = torch.zeros(r.size(0), r.size(1), r.size(-1), v.size(-1), device=r.device, dtype=r.dtype)
+        if w_log_scalar is not None:
+            w = w_log_scalar.exp().view(1,-1,1,1)
+        # single step decoding is launch overhead bound, so do it in a single kernel when we can
+        if rwkv5_wkv_available(r, k, v, w, u, kv_state):
+            return rwkv5_wkv_forward(r, k, v, w, u, kv_state)
+        return _rwkv_inner_step(r, k, v, w, u, kv_state)
+
+    if precision_dtype is None:
+        precision_dtype = (w if w is not None else w_log_scalar).dtype
+        if precision_dtype == torch.float16:
+            precision_dtype = torch.float32 # fp16 doesn't have the exponent range for the decays
+
+    # FIXME - support fast path for non-exact multiples
+    # ensure it's an exact multiple
+    if L % chunk_len != 0:
+        chunk_len = 1
+    return _rwkv_inner_chunked(r, k, v, w, u, kv_state, chunk_len, precision_dtype, w_log_scalar)
@@ -0,0 +1,22 @@
+import torch
+
+from torch import Tensor
+
+def wkv_intra_chunk_reference(q : Tensor, k : Tensor, d : Tensor, v : Tensor):
+    """
+    intra-chunk attention of rwkv_inner, (tril(q @ k.mT, -1) + diag(d)) @ v
+    expects
+    q : (B,KVH,G,N,T,K)
+    k : (B,KVH,G,N,T,K) or (B,KVH,1,N,T,K)
+    d : (B,KVH,G,N,T)
+    v : (B,KVH,N,T,V)
+    returns
+    out : (B,KVH,G,N,T,V)
+    """
+    # einsum broadcasts a k given per k/v head over the group axis by folding it into the rows of the matmul, so k is never expanded
+    a = torch.einsum('bhgnik,bhgnjk->bhgnij', q, k).to(v.dtype).tril(-1) # BHGNTT
+    # add u term to attention (NOTE - the tril(-1) above zeroed the diagonal)
+    # writing through a diagonal view of the fresh tril output avoids materializing a (T,T) diag_embed just to add T values
+    torch.diagonal(a, dim1=-2, dim2=-1).add_(d.to(a.dtype))
+    # likewise the group axis is folded into the rows here, so v is shared rather than expanded
+    return torch.einsum('bhgnij,bhnjv->bhgniv', a, v) # BHGNTV